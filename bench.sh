@@ -0,0 +1,8 @@
+#!/bin/sh
+# time elaboration of targets that use define_subst heavily
+
+for i in i386 aarch64 ;
+do
+    echo "$i"
+    time python parse_gcc_rtl.py --expansion-stats $1/gcc/config/$i/$i.md 2>&1 > /dev/null | grep '^total'
+done
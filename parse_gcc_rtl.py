@@ -1,6 +1,15 @@
 from enum import Enum
+from array import array
+import argparse
+import bisect
+import hashlib
+import itertools
+import json
+import pickle
+import sqlite3
 import sys
 import os
+import urllib.parse
 
 saved_ast = None
 class TokenKind(Enum):
@@ -215,22 +224,30 @@ def get_lex_handler(buffer:str, start:int):
         raise ValueError()
     return handler
 
+# yield (start, end, token) for every token in buffer
+def lex_buffer(buffer:str):
+    start = 0
+    buffer_len = len(buffer)
+    while start < buffer_len:
+        start = skip_space(buffer, start)
+        if (start >= buffer_len):
+            return
+        handler = get_lex_handler(buffer, start)
+        end, token = handler(buffer, start)
+        yield (start, end, token)
+        start = end
+
 class Lexer:
     def __init__(self, file_name:str):
         self.buffer = []
         self.next = 0
         with open(file_name, 'r') as fin:
-            buffer = fin.read()
-            start = 0
-            buffer_len = len(buffer)
-            while start < buffer_len:
-                start = skip_space(buffer, start)
-                if (start >= buffer_len):
-                    return
-                handler = get_lex_handler(buffer, start)
-                start, token = handler(buffer, start)
+            for _, _, token in lex_buffer(fin.read()):
                 self.buffer.append(token)
 
+    def at_end(self):
+        return self.next >= len(self.buffer)
+
     def peek(self, arg = None):
         if arg == None:
             arg = 0
@@ -240,6 +257,8 @@ class Lexer:
             return self.buffer[self.next][0] == arg
         else:
             raise ValueError()
+    def peek_kind(self):
+        return self.buffer[self.next][0]
     def consume(self, arg):
         if arg != None:
             assert self.buffer[self.next][0] == arg
@@ -247,6 +266,67 @@ class Lexer:
         self.next += 1
         return result
 
+# same interface as Lexer, but tokens are kept as parallel arrays of
+# kind/start/end offsets into the source buffer, the token text is only
+# materialized when the parser asks for it
+class ArrayLexer:
+    def __init__(self, file_name:str):
+        self.kinds = array('b')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.next = 0
+        with open(file_name, 'r') as fin:
+            self.source = fin.read()
+        for start, end, token in lex_buffer(self.source):
+            self.kinds.append(token[0].value)
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def at_end(self):
+        return self.next >= len(self.kinds)
+
+    def token_text(self, index:int):
+        kind = self.kinds[index]
+        start = self.starts[index]
+        end = self.ends[index]
+        if kind == TokenKind.Identifier.value:
+            text = self.source[start:end]
+            if ' ' in text:
+                text = text.replace(' ', '')
+            return text
+        if kind == TokenKind.Number.value:
+            return self.source[start:end]
+        if kind == TokenKind.String.value:
+            if self.source[start] == '"':
+                # c string escapes are dropped, rerun the lexer on it
+                return lex_c_string(self.source, start)[1][1]
+            return self.source[start:end]
+        return None
+
+    def token(self, index:int):
+        return (TokenKind(self.kinds[index]), self.token_text(index))
+
+    def peek(self, arg = None):
+        if arg == None:
+            arg = 0
+        if isinstance(arg, int):
+            return self.token(self.next + arg)
+        elif isinstance(arg, TokenKind):
+            return self.kinds[self.next] == arg.value
+        else:
+            raise ValueError()
+    def peek_kind(self):
+        return TokenKind(self.kinds[self.next])
+    def consume(self, arg):
+        if arg != None:
+            assert self.kinds[self.next] == arg.value
+        result = self.token(self.next)
+        self.next += 1
+        return result
+
 class Iterator:
     def __init__(self, ast):
         def strip(v):
@@ -290,12 +370,318 @@ class IteratorAttribute:
     def __repr__(self):
         return '{{name: {}, mapping: {}}}'.format(self.name, self.mapping)
 
+# (define_subst_attr "name" "subst" "no-subst value" "subst value")
+class SubstAttribute:
+    def __init__(self, ast):
+        l = ast[1]
+        self.name = l[1][1]
+        self.subst = l[2][1]
+        self.no_value = l[3][1]
+        self.value = l[4][1]
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return '{{name: {}, subst: {}, values: {}}}'.format(self.name, self.subst, (self.no_value, self.value))
+
+operand_forms = ('match_operand', 'match_scratch', 'match_operator', 'match_parallel')
+dup_forms = ('match_dup', 'match_op_dup', 'match_par_dup')
+
+# (define_subst "name" [input] "condition" [output])
+# the input template is compiled once into a matcher tree, iterators used
+# in it match any of their members and bind to the member they matched,
+# the output template is instantiated once per such binding
+class SubstTemplate:
+    def __init__(self, ast, elaborator):
+        l = ast[1]
+        self.ast = ast
+        self.name = l[1][1]
+        self.condition = l[3][1]
+        self.output = l[4]
+        # itor -> 'mode' / 'code' / 'int'
+        self.itor_tables = {}
+        self.tables = {
+            'mode': elaborator.all_mode_itors,
+            'code': elaborator.all_code_itors,
+        }
+        self.matchers = [self.compile(x) for x in l[2][1]]
+        self.output_itors = set()
+        self.find_output_itors(self.output, elaborator)
+        del self.tables
+        # binding -> instantiated output
+        self.outputs = {}
+        self.hash = None
+
+    def compile_name(self, name, table):
+        if name == None:
+            return None
+        itor = self.tables[table].get(name, None)
+        if itor == None:
+            return name
+        self.itor_tables[itor] = table
+        return (itor, {m[0]: i for i, m in enumerate(itor.members)})
+
+    def compile(self, ast):
+        k = ast[0]
+        if k == ASTKind.Vector:
+            return ('vec', [self.compile(x) for x in ast[1]])
+        if k != ASTKind.List or len(ast[1]) == 0 or ast[1][0][0] != ASTKind.Identifier:
+            return ('leaf', ast)
+        code, mode = Elaborator.split_identifier_for_mode(ast[1][0][1])
+        mode = self.compile_name(mode, 'mode')
+        if code in operand_forms:
+            children = None
+            # (match_operator:M n "predicate" [operands])
+            if code == 'match_operator' and len(ast[1]) > 3 and ast[1][3][0] == ASTKind.Vector:
+                children = [self.compile(x) for x in ast[1][3][1]]
+            return ('op', int(ast[1][1][1]), mode, children)
+        if code in dup_forms:
+            return ('dup', int(ast[1][1][1]))
+        return ('expr', self.compile_name(code, 'code'), mode, [self.compile(x) for x in ast[1][1:]])
+
+    def find_output_itors(self, ast, elaborator):
+        k = ast[0]
+        if k == ASTKind.Identifier:
+            code, mode = Elaborator.split_identifier_for_mode(ast[1])
+            if (itor := elaborator.all_mode_itors.get(mode, None)) != None:
+                self.output_itors.add(itor)
+            if (itor := elaborator.all_code_itors.get(code, None)) != None:
+                self.output_itors.add(itor)
+        elif k == ASTKind.List or k == ASTKind.Vector:
+            for m in ast[1]:
+                self.find_output_itors(m, elaborator)
+
+    @staticmethod
+    def check_name(c, name, binding):
+        if c == None:
+            return True
+        if isinstance(c, str):
+            return c == name
+        itor, index = c
+        i = index.get(name, None)
+        if i == None or binding.get(itor, i) != i:
+            return False
+        binding[itor] = i
+        return True
+
+    def match(self, m, x, operands, binding):
+        k = m[0]
+        if k == 'leaf':
+            return m[1] == x
+        if k == 'vec':
+            if x[0] != ASTKind.Vector or len(x[1]) != len(m[1]):
+                return False
+            for cm, cx in zip(m[1], x[1]):
+                if not self.match(cm, cx, operands, binding):
+                    return False
+            return True
+        if k == 'dup':
+            return operands.get(m[1], None) == x
+        if x[0] != ASTKind.List or len(x[1]) == 0 or x[1][0][0] != ASTKind.Identifier:
+            return False
+        code, mode = Elaborator.split_identifier_for_mode(x[1][0][1])
+        if k == 'op':
+            _, n, mode_c, children = m
+            if not SubstTemplate.check_name(mode_c, mode, binding):
+                return False
+            if children != None:
+                # operands of the matched expression, which may itself be
+                # a match_operator of the insn
+                if code == 'match_operator':
+                    if len(x[1]) < 4 or x[1][3][0] != ASTKind.Vector:
+                        return False
+                    x_operands = x[1][3][1]
+                else:
+                    x_operands = x[1][1:]
+                if len(children) != len(x_operands):
+                    return False
+                for cm, cx in zip(children, x_operands):
+                    if not self.match(cm, cx, operands, binding):
+                        return False
+            if operands.setdefault(n, x) != x:
+                return False
+            return True
+        _, code_c, mode_c, children = m
+        if not SubstTemplate.check_name(code_c, code, binding) or not SubstTemplate.check_name(mode_c, mode, binding):
+            return False
+        if len(children) != len(x[1]) - 1:
+            return False
+        for cm, cx in zip(children, x[1][1:]):
+            if not self.match(cm, cx, operands, binding):
+                return False
+        return True
+
+    # replace the operands bound by the input template, shift the other
+    # operand numbers by offset so they don't clash with the insn's
+    def fill(self, ast, operands, offset):
+        k = ast[0]
+        if k == ASTKind.Vector:
+            return (k, [self.fill(x, operands, offset) for x in ast[1]])
+        if k != ASTKind.List or len(ast[1]) == 0 or ast[1][0][0] != ASTKind.Identifier:
+            return ast
+        code, _ = Elaborator.split_identifier_for_mode(ast[1][0][1])
+        if code in operand_forms or code in dup_forms:
+            n = int(ast[1][1][1])
+            if n in operands:
+                return operands[n]
+            l = list(ast[1])
+            l[1] = (ASTKind.Number, str(n + offset))
+            return (k, [self.fill(x, operands, offset) for x in l])
+        return (k, [self.fill(x, operands, offset) for x in ast[1]])
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return '{{name: {}, condition: {}}}'.format(self.name, self.condition)
+
+def find_operand_numbers(ast, numbers):
+    k = ast[0]
+    if k == ASTKind.List and len(ast[1]) > 1 and ast[1][0][0] == ASTKind.Identifier:
+        code, _ = Elaborator.split_identifier_for_mode(ast[1][0][1])
+        if (code in operand_forms or code in dup_forms) and ast[1][1][0] == ASTKind.Number:
+            numbers.add(int(ast[1][1][1]))
+    if k == ASTKind.List or k == ASTKind.Vector:
+        for m in ast[1]:
+            find_operand_numbers(m, numbers)
+
+def join_c_conditions(a, b):
+    if a == '':
+        return b
+    if b == '':
+        return a
+    return '({}) && ({})'.format(a, b)
+
+# posting lists of match_operand / match_dup / match_scratch occurrences in
+# elaborated patterns, keyed by (field, value), field is one of kind,
+# predicate, constraint, mode and operand; postings hold occurrence ids so
+# that all terms of a query have to hold for the same operand
+class OperandIndex:
+    forms = ('match_operand', 'match_dup', 'match_scratch')
+    fields = ('kind', 'predicate', 'constraint', 'mode', 'operand')
+    # constraint modifiers and cost hints, ignored when indexing
+    constraint_modifiers = '=+&%?!*^$'
+
+    def __init__(self):
+        # (field, value) -> array('i') of increasing occurrence ids
+        self.postings = {}
+        # occurrence id -> pattern id
+        self.occurrences = array('i')
+        # pattern id -> (form, name)
+        self.patterns = []
+
+    def post(self, field, value, occurrence_id):
+        posting = self.postings.get((field, value), None)
+        if posting == None:
+            posting = self.postings[(field, value)] = array('i')
+        elif posting[-1] == occurrence_id:
+            return
+        posting.append(occurrence_id)
+
+    # a constraint is posted as written and as each of its alternatives
+    # without modifiers, so constraint=v matches "=v" and "v,m" but not
+    # "vm"; letters are not split since constraints can be multi-letter
+    def post_constraint(self, constraint, occurrence_id):
+        values = set([constraint])
+        for alternative in constraint.split(','):
+            alternative = ''.join(c for c in alternative if c not in OperandIndex.constraint_modifiers)
+            if alternative != '':
+                values.add(alternative)
+        for value in sorted(values):
+            self.post('constraint', value, occurrence_id)
+
+    def add_impl(self, ast, pattern_id):
+        k = ast[0]
+        if k == ASTKind.Vector:
+            for m in ast[1]:
+                self.add_impl(m, pattern_id)
+            return
+        if k != ASTKind.List or len(ast[1]) == 0:
+            return
+        l = ast[1]
+        if l[0][0] == ASTKind.Identifier:
+            code, mode = Elaborator.split_identifier_for_mode(l[0][1])
+            if code in OperandIndex.forms and len(l) > 1:
+                occurrence_id = len(self.occurrences)
+                self.occurrences.append(pattern_id)
+                self.post('kind', code, occurrence_id)
+                self.post('operand', l[1][1], occurrence_id)
+                if mode != None:
+                    self.post('mode', mode, occurrence_id)
+                if code == 'match_operand':
+                    if len(l) > 2:
+                        self.post('predicate', l[2][1], occurrence_id)
+                    if len(l) > 3:
+                        self.post_constraint(l[3][1], occurrence_id)
+                elif code == 'match_scratch' and len(l) > 2:
+                    self.post_constraint(l[2][1], occurrence_id)
+                return
+        for m in l:
+            self.add_impl(m, pattern_id)
+
+    def add(self, ast):
+        pattern_id = len(self.patterns)
+        self.patterns.append((Elaborator.get_list_form(ast), Elaborator.get_form_name(ast)))
+        self.add_impl(ast, pattern_id)
+        return pattern_id
+
+    @staticmethod
+    def contains(posting, occurrence_id):
+        i = bisect.bisect_left(posting, occurrence_id)
+        return i < len(posting) and posting[i] == occurrence_id
+
+    # ids of patterns with an operand that has all of the given
+    # (field, value) pairs
+    def query(self, **kwargs):
+        postings = [self.postings.get((field, value), array('i')) for field, value in kwargs.items()]
+        if len(postings) == 0:
+            return list(range(len(self.patterns)))
+        postings.sort(key=len)
+        result = list(postings[0])
+        for posting in postings[1:]:
+            result = [i for i in result if OperandIndex.contains(posting, i)]
+        # occurrence ids increase with pattern ids
+        patterns = []
+        for i in result:
+            pattern_id = self.occurrences[i]
+            if len(patterns) == 0 or patterns[-1] != pattern_id:
+                patterns.append(pattern_id)
+        return patterns
+
+class BudgetPolicy(Enum):
+    Stream = 1
+    Truncate = 2
+    Fail = 3
+
+class ExpansionBudgetExceeded(ValueError):
+    pass
+
 class Elaborator():
-    def __init__(self, working_dir):
+    def __init__(self, working_dir, form_budget = None, run_budget = None, budget_policy = BudgetPolicy.Stream, lexer_class = None,
+                 prune_itors = True, dedup = True, cache = None, index = None):
         super().__init__()
         self.working_dir = working_dir
         if self.working_dir[-1] != '/':
             self.working_dir += '/'
+        self.lexer_class = lexer_class if lexer_class != None else Lexer
+        # budgets are counted in instantiations, None means unlimited
+        self.form_budget = form_budget
+        self.run_budget = run_budget
+        self.budget_policy = budget_policy
+        self.prune_itors = prune_itors
+        self.dedup = dedup
+        self.cache = cache
+        self.index = index
+        # file the form being elaborated comes from and the iterator members
+        # the last instantiation yielded by elab_iter was made of
+        self.source_file = None
+        self.itor_values = ()
+        self.expansion_total = 0
+        self.pruned_total = 0
+        self.duplicates_total = 0
+        # list of [form, name, estimated, actual, pruned itors, duplicates, over budget]
+        self.expansion_stats = []
         self.elab_init()
         self.all_mode_itors = {}
         self.all_mode_attrs = {}
@@ -303,6 +689,8 @@ class Elaborator():
         self.all_int_attrs = {}
         self.all_code_itors = {}
         self.all_code_attrs = {}
+        self.all_substs = {}
+        self.all_subst_attrs = {}
 
     def dump_all_itors(self, os=sys.stdout):
         print('all_mode_itors: {}'.format(self.all_mode_itors), file=os)
@@ -311,6 +699,15 @@ class Elaborator():
         print('all_code_attrs: {}'.format(self.all_code_attrs), file=os)
         print('all_int_itors: {}'.format(self.all_int_itors), file=os)
         print('all_int_attrs: {}'.format(self.all_int_attrs), file=os)
+        print('all_substs: {}'.format(self.all_substs), file=os)
+        print('all_subst_attrs: {}'.format(self.all_subst_attrs), file=os)
+
+    def dump_expansion_stats(self, os=sys.stdout):
+        for form, name, estimated, actual, pruned, duplicates, over_budget in self.expansion_stats:
+            print('{}\t{}\testimated: {}\tactual: {}\tpruned itors: {}\tduplicates: {}{}'.format(
+                form, name, estimated, actual, pruned, duplicates, '\tover budget' if over_budget else ''), file=os)
+        print('total: {}\tpruned itors: {}\tduplicates: {}'.format(
+            self.expansion_total, self.pruned_total, self.duplicates_total), file=os)
 
     def bad(self, ast, message):
         return (ASTKind.Bad, (message, ast))
@@ -427,10 +824,18 @@ class Elaborator():
             for m in ast[1]:
                 self.find_itors(m)
 
+    # ((itor name, member), ...) of the current instantiation
+    def current_itor_values(self):
+        return tuple((k.name, k.members[d[k]][0])
+                     for d in (self.mode_itor, self.int_itor, self.code_itor)
+                     for k in d if k not in self.frozen_itors)
+
     def elab_init(self):
         self.mode_itor = {}
         self.int_itor = {}
         self.code_itor = {}
+        # itors that stay at their first member, they have no effect on output
+        self.frozen_itors = set()
 
     def do_substitute(self, ast):
         switcher = {
@@ -450,12 +855,229 @@ class Elaborator():
                 return ast[1][0][1]
         return None
 
+    @staticmethod
+    def get_form_name(ast):
+        if ast[0] == ASTKind.List and len(ast[1]) > 1:
+            if ast[1][1][0] in (ASTKind.String, ASTKind.Identifier):
+                return ast[1][1][1]
+        return None
+
+    # number of instantiations the current iterator state will produce,
+    # computed from member counts only, call after find_itors
+    def estimate_expansion(self):
+        result = 1
+        for d in (self.mode_itor, self.int_itor, self.code_itor):
+            for k in d:
+                if k not in self.frozen_itors:
+                    result *= len(k.members)
+        return result
+
+    def find_attr_refs(self, name, refs):
+        for x in Elaborator.split_string_for_substitute(name):
+            if len(x) > 2 and x[0] == '<' and x[-1] == '>':
+                parts = x[1:-1].split(':')
+                if len(parts) == 1:
+                    refs['attrs'].add(parts[0])
+                else:
+                    refs['prefixed'].add(parts[0])
+
+    # names the substitute_* functions can resolve through an itor:
+    # 'modes' and 'codes' are substituted as itor names, 'prefixed' are
+    # the itors of <itor:attr>, 'attrs' are the attrs of <attr>
+    def find_itor_refs(self, ast, refs):
+        k = ast[0]
+        if k == ASTKind.String:
+            self.find_attr_refs(ast[1], refs)
+        elif k == ASTKind.Identifier:
+            prefix, mode = Elaborator.split_identifier_for_mode(ast[1])
+            if mode != None:
+                refs['modes'].add(mode)
+                self.find_attr_refs(mode, refs)
+            refs['codes'].add(prefix)
+            self.find_attr_refs(prefix, refs)
+        elif k == ASTKind.List or k == ASTKind.Vector:
+            for m in ast[1]:
+                self.find_itor_refs(m, refs)
+
+    # find_itors is name based and over-approximates, freeze every itor
+    # that provably can't change the output: it is never substituted by
+    # name, never used as <itor:attr>, and none of its members has a
+    # mapping in any <attr> of the form; the rest is left to dedup
+    def prune_irrelevant_itors(self, ast):
+        refs = {'modes': set(), 'codes': set(), 'prefixed': set(), 'attrs': set()}
+        self.find_itor_refs(ast, refs)
+        pruned = 0
+        for d, names, builtins, all_attrs in (
+                (self.mode_itor, refs['modes'], ('mode', 'MODE'), self.all_mode_attrs),
+                (self.int_itor, (), (), self.all_int_attrs),
+                (self.code_itor, refs['codes'], ('code', 'CODE'), self.all_code_attrs)):
+            for k in d:
+                if k.name in names or k.name in refs['prefixed']:
+                    continue
+                if any(b in refs['attrs'] for b in builtins):
+                    continue
+                relevant = False
+                for name in refs['attrs']:
+                    attr = all_attrs.get(name, None)
+                    if attr != None and any(m[0] in attr.mapping for m in k.members):
+                        relevant = True
+                        break
+                if not relevant:
+                    self.frozen_itors.add(k)
+                    pruned += 1
+        return pruned
+
+    # (how many instantiations of a form with estimated size are allowed,
+    # whether it is over budget)
+    def check_budget(self, ast, estimated):
+        limit = estimated
+        if self.form_budget != None:
+            limit = min(limit, self.form_budget)
+        if self.run_budget != None:
+            limit = min(limit, max(self.run_budget - self.expansion_total, 0))
+        if limit == estimated:
+            return (estimated, False)
+        message = '{} {}: expands to {} instantiations, budget allows {}'.format(
+            Elaborator.get_list_form(ast), Elaborator.get_form_name(ast), estimated, limit)
+        if self.budget_policy == BudgetPolicy.Fail:
+            raise ExpansionBudgetExceeded(message)
+        if self.budget_policy == BudgetPolicy.Stream:
+            print('warning: streamed over budget, ' + message, file=sys.stderr)
+            return (estimated, True)
+        print('warning: truncated, ' + message, file=sys.stderr)
+        return (limit, True)
+
+    def find_attr_names(self, ast, names):
+        k = ast[0]
+        if k == ASTKind.String or k == ASTKind.Identifier:
+            for name in Elaborator.split_string_for_substitute(ast[1]):
+                if len(name) > 2 and name[0] == '<' and name[-1] == '>':
+                    names.add(name[1:-1].split(':')[-1])
+        elif k == ASTKind.List or k == ASTKind.Vector:
+            for m in ast[1]:
+                self.find_attr_names(m, names)
+
+    # hash of the iterator and attribute definitions ast can depend on,
+    # call after find_itors
+    def dependency_hash(self, ast):
+        h = hashlib.sha1()
+        for kind, d in (('mode', self.mode_itor), ('int', self.int_itor), ('code', self.code_itor)):
+            for k in sorted(d, key=lambda x: x.name):
+                h.update(repr((kind, k.name, k.members)).encode())
+        names = set()
+        self.find_attr_names(ast, names)
+        for name in sorted(names):
+            for kind, all_attrs in (('mode', self.all_mode_attrs), ('int', self.all_int_attrs), ('code', self.all_code_attrs)):
+                if (attr := all_attrs.get(name, None)) != None:
+                    h.update(repr((kind, attr.name, sorted(attr.mapping.items()))).encode())
+        return h.hexdigest()
+
+    def subst_hash(self, subst):
+        if subst.hash == None:
+            h = hashlib.sha1()
+            h.update(form_hash(subst.ast).encode())
+            for itor in sorted(set(subst.itor_tables) | subst.output_itors, key=lambda x: x.name):
+                h.update(repr((itor.name, itor.members)).encode())
+            names = set()
+            self.find_attr_names(subst.output, names)
+            for name in sorted(names):
+                for all_attrs in (self.all_mode_attrs, self.all_int_attrs, self.all_code_attrs):
+                    if (attr := all_attrs.get(name, None)) != None:
+                        h.update(repr((attr.name, sorted(attr.mapping.items()))).encode())
+            subst.hash = h.hexdigest()
+        return subst.hash
+
+    # key of the expansion result of ast, call after find_itors
+    def expansion_key(self, ast, substs = ()):
+        h = hashlib.sha1()
+        h.update(form_hash(ast).encode())
+        h.update(self.dependency_hash(ast).encode())
+        for subst in substs:
+            h.update(self.subst_hash(subst).encode())
+        h.update(b'dedup' if self.dedup else b'')
+        h.update(b'prune' if self.prune_itors else b'')
+        return h.hexdigest()
+
+    def replace_subst_attrs(self, ast, values):
+        k = ast[0]
+        if k == ASTKind.String or k == ASTKind.Identifier:
+            ids = Elaborator.split_string_for_substitute(ast[1])
+            return (k, ''.join([values.get(x[1:-1], x) if x[:1] == '<' else x for x in ids]))
+        if k == ASTKind.List or k == ASTKind.Vector:
+            return (k, [self.replace_subst_attrs(x, values) for x in ast[1]])
+        return ast
+
+    # [(ast, substs to apply)], one for every combination of the
+    # define_substs whose subst attributes ast refers to
+    def subst_variants(self, ast, form):
+        if form not in ('define_insn', 'define_expand') or len(self.all_subst_attrs) == 0:
+            return [(ast, ())]
+        names = set()
+        self.find_attr_names(ast, names)
+        attrs = [self.all_subst_attrs[n] for n in names if n in self.all_subst_attrs]
+        if len(attrs) == 0:
+            return [(ast, ())]
+        substs = [s for s in self.all_substs.values() if any(a.subst == s.name for a in attrs)]
+        result = []
+        for applied in itertools.product((False, True), repeat=len(substs)):
+            applied_names = set(s.name for s, a in zip(substs, applied) if a)
+            values = {a.name: a.value if a.subst in applied_names else a.no_value for a in attrs}
+            result.append((self.replace_subst_attrs(ast, values), tuple(s for s, a in zip(substs, applied) if a)))
+        return result
+
+    def instantiate_subst_output(self, subst, binding):
+        key = tuple(sorted((itor.name, i) for itor, i in binding.items()))
+        if key in subst.outputs:
+            return subst.outputs[key]
+        result = None
+        if all(itor in binding for itor in subst.output_itors):
+            saved = (self.mode_itor, self.int_itor, self.code_itor, self.frozen_itors)
+            self.mode_itor = {k: i for k, i in binding.items() if subst.itor_tables[k] == 'mode'}
+            self.code_itor = {k: i for k, i in binding.items() if subst.itor_tables[k] == 'code'}
+            self.int_itor = {}
+            self.frozen_itors = set()
+            result = self.do_substitute(subst.output)
+            self.mode_itor, self.int_itor, self.code_itor, self.frozen_itors = saved
+        subst.outputs[key] = result
+        return result
+
+    # ast with subst applied, None if its pattern doesn't match
+    def apply_subst(self, ast, subst):
+        l = ast[1]
+        pattern = l[2][1]
+        if len(pattern) != len(subst.matchers):
+            return None
+        operands = {}
+        binding = {}
+        for m, x in zip(subst.matchers, pattern):
+            if not subst.match(m, x, operands, binding):
+                return None
+        output = self.instantiate_subst_output(subst, binding)
+        if output == None:
+            return None
+        numbers = set()
+        find_operand_numbers(l[2], numbers)
+        new_numbers = set()
+        find_operand_numbers(output, new_numbers)
+        new_numbers -= set(operands)
+        offset = 0
+        if len(new_numbers) != 0:
+            offset = max(numbers, default=-1) + 1 - min(new_numbers)
+        l = list(l)
+        l[2] = subst.fill(output, operands, offset)
+        l[3] = (ASTKind.String, join_c_conditions(subst.condition, l[3][1]))
+        return (ASTKind.List, l)
+
     def elab(self, ast_):
-        asts = [ast_]
+        return list(self.elab_iter(ast_))
+
+    def elab_iter(self, ast_):
         form = Elaborator.get_list_form(ast_)
         if form != None:
             switcher = {
                 'include': self.handle_include,
+                "define_subst": self.handle_define_subst,
+                "define_subst_attr": self.handle_define_subst_attr,
                 "define_mode_iterator": self.handle_define_mode_iterator,
                 "define_mode_attr": self.handle_define_mode_attr,
                 "define_code_iterator": self.handle_define_code_iterator,
@@ -466,31 +1088,87 @@ class Elaborator():
             handler = switcher.get(form, None)
             if handler != None:
                 ast_ = handler(ast_)
-                if isinstance(ast_, list):
-                    return ast_
+                if isinstance(ast_, tuple):
+                    self.itor_values = ()
+                    yield ast_
                 else:
-                    return [ast_]
+                    yield from ast_
+                return
         def bump(d):
             for k in d:
+                if k in self.frozen_itors:
+                    continue
                 if d[k] + 1 < len(k.members):
                     d[k] += 1
                     return True
                 else:
                     d[k] = 0
             return False
-        result = []
-        for ast in asts:
+        for ast, substs in self.subst_variants(ast_, form):
             global saved_ast
             saved_ast = ast
             self.elab_init()
             self.find_itors(ast)
-            while True:
-                result.append(self.do_substitute(ast))
+            name = Elaborator.get_form_name(ast)
+            expanded = None
+            if self.cache != None:
+                key = self.expansion_key(ast, substs)
+                self.cache.record_form(form, name, key, ast)
+                if (cached := self.cache.lookup(key)) != None:
+                    estimated, pruned, duplicates, results = cached
+                    self.pruned_total += pruned
+                    self.duplicates_total += duplicates
+                    limit, over_budget = self.check_budget(ast, estimated)
+                    stat = [form, name, estimated, 0, pruned, duplicates, over_budget]
+                    self.expansion_stats.append(stat)
+                    for result, itor_values in results[:limit]:
+                        stat[3] += 1
+                        self.expansion_total += 1
+                        self.itor_values = itor_values
+                        result = ast_from_plain(result)
+                        if self.index != None:
+                            self.index.add(result)
+                        yield result
+                    continue
+                expanded = []
+            pruned = self.prune_irrelevant_itors(ast) if self.prune_itors else 0
+            self.pruned_total += pruned
+            estimated = self.estimate_expansion()
+            limit, over_budget = self.check_budget(ast, estimated)
+            stat = [form, name, estimated, 0, pruned, 0, over_budget]
+            self.expansion_stats.append(stat)
+            seen = set()
+            while stat[3] < limit:
+                result = self.do_substitute(ast)
+                for subst in substs:
+                    if result == None:
+                        break
+                    result = self.apply_subst(result, subst)
+                if result != None and self.dedup and estimated > 1:
+                    # only a fixed size digest per instantiation is kept
+                    digest = form_hash(result)
+                    if digest in seen:
+                        stat[5] += 1
+                        self.duplicates_total += 1
+                        result = None
+                    else:
+                        seen.add(digest)
+                if result != None:
+                    stat[3] += 1
+                    self.expansion_total += 1
+                    self.itor_values = self.current_itor_values()
+                    if expanded != None:
+                        expanded.append((ast_to_plain(result), self.itor_values))
+                    if self.index != None:
+                        self.index.add(result)
+                    yield result
                 if bump(self.mode_itor) or bump(self.int_itor) or bump(self.code_itor):
                     continue
                 else:
+                    # only complete expansions are cached
+                    if expanded != None:
+                        self.cache.store(key, (estimated, pruned, stat[5], expanded))
                     break;
-        return result
 
     def try_substitute_mode(self, name):
         name_len = len(name)
@@ -627,27 +1305,21 @@ class Elaborator():
         return (ASTKind.List, [self.do_substitute(x) for x in ast[1]])
 
     def include_handler_impl(self, path):
-        result = []
-        lexer = Lexer(self.working_dir + path)
+        lexer = self.lexer_class(self.working_dir + path)
         syntax_trees = parse_rtl_file(lexer)
+        saved_source_file = self.source_file
+        self.source_file = path
         for tree in syntax_trees:
-            t = self.elab(tree)
-            if isinstance(t, list):
-                result += t
-            else:
-                result.append(t)
-        return result
+            yield from self.elab_iter(tree)
+        self.source_file = saved_source_file
 
     def handle_include(self, ast):
         include_spec = ast[1][1]
         if include_spec[0] == ASTKind.String:
-            return self.include_handler_impl(include_spec[1])
+            yield from self.include_handler_impl(include_spec[1])
         elif include_spec[0] == ASTKind.List:
-            result = []
             for spec in include_spec[1]:
-                result += self.include_handler_impl(spec[1])
-            return result
-        return []
+                yield from self.include_handler_impl(spec[1])
 
     def handle_define_mode_iterator(self, ast):
         itor = Iterator(ast)
@@ -679,6 +1351,16 @@ class Elaborator():
         self.all_int_attrs[attr.name] = attr
         return ast
 
+    def handle_define_subst(self, ast):
+        subst = SubstTemplate(ast, self)
+        self.all_substs[subst.name] = subst
+        return ast
+
+    def handle_define_subst_attr(self, ast):
+        attr = SubstAttribute(ast)
+        self.all_subst_attrs[attr.name] = attr
+        return ast
+
     def elab_list(self, ast):
         lst = ast[1]
         if len(lst) == 0:
@@ -695,6 +1377,173 @@ class Elaborator():
 
 # token is tuple(TokenKind, data)
 # ASTNode is tuple(ASTKind, data)
+# ast with ASTKind replaced by its value, for storing outside this module
+def ast_to_plain(ast):
+    if ast[0] == ASTKind.List or ast[0] == ASTKind.Vector:
+        return (ast[0].value, [ast_to_plain(x) for x in ast[1]])
+    return (ast[0].value, ast[1])
+
+def ast_from_plain(plain):
+    k = ASTKind(plain[0])
+    if k == ASTKind.List or k == ASTKind.Vector:
+        return (k, [ast_from_plain(x) for x in plain[1]])
+    return (k, plain[1])
+
+def hash_ast_impl(ast, h):
+    k = ast[0]
+    if k == ASTKind.List or k == ASTKind.Vector:
+        h.update('{}{}('.format(k.value, len(ast[1])).encode())
+        for m in ast[1]:
+            hash_ast_impl(m, h)
+        h.update(b')')
+    else:
+        data = ast[1].encode()
+        h.update('{}{}:'.format(k.value, len(data)).encode())
+        h.update(data)
+
+# stable content hash of a form, independent of python's hash seed
+def form_hash(ast):
+    h = hashlib.sha1()
+    hash_ast_impl(ast, h)
+    return h.hexdigest()
+
+# expansion results of one root .md file of a target keyed by
+# Elaborator.expansion_key, kept across runs so that a new gcc snapshot
+# only re-elaborates changed forms; every (target, root file) has its own
+# file under cache_dir, so runs on different files never touch each other
+class ExpansionCache:
+    def __init__(self, cache_dir:str, target:str, source_file:str):
+        self.target = target
+        self.source_file = source_file
+        self.file_name = os.path.join(cache_dir, urllib.parse.quote(target, safe=''),
+                                      urllib.parse.quote(source_file, safe='') + '.pickle')
+        self.old_forms, self.old_results = self.load()
+        # '<form> <name>#<n>' -> key
+        self.forms = {}
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    # (forms, results)
+    def load(self):
+        if not os.path.exists(self.file_name):
+            return ({}, {})
+        with open(self.file_name, 'rb') as fin:
+            return pickle.load(fin)
+
+    # forms without a name are told apart by their content, so adding one
+    # doesn't renumber the others
+    def record_form(self, form, name, key, ast):
+        if name == None or name == '':
+            name = '@' + form_hash(ast)
+        n = 0
+        while '{} {}#{}'.format(form, name, n) in self.forms:
+            n += 1
+        self.forms['{} {}#{}'.format(form, name, n)] = key
+
+    def lookup(self, key):
+        result = self.results.get(key, None)
+        if result == None:
+            result = self.old_results.get(key, None)
+            if result != None:
+                self.results[key] = result
+        if result == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def store(self, key, value):
+        self.results[key] = value
+
+    # (added, removed, changed) pattern names against the previous run
+    def diff(self):
+        added = [f for f in self.forms if f not in self.old_forms]
+        removed = [f for f in self.old_forms if f not in self.forms]
+        changed = [f for f in self.forms if f in self.old_forms and self.forms[f] != self.old_forms[f]]
+        return (added, removed, changed)
+
+    def dump_diff(self, os=sys.stdout):
+        added, removed, changed = self.diff()
+        for kind, forms in (('added', added), ('removed', removed), ('changed', changed)):
+            for f in forms:
+                print('{}\t{}\t{}\t{}'.format(self.target, self.source_file, kind, f), file=os)
+        print('{}\t{}\tcache hits: {}\tmisses: {}'.format(self.target, self.source_file, self.hits, self.misses), file=os)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        tmp_name = '{}.{}.tmp'.format(self.file_name, os.getpid())
+        with open(tmp_name, 'wb') as fout:
+            pickle.dump((self.forms, self.results), fout)
+        os.replace(tmp_name, self.file_name)
+
+# writes elaborated forms of one root .md file of a target into a sqlite
+# database, source_file is the (possibly included) file a form comes from;
+# rows are loaded in batches into temp tables of this connection and only
+# replace the previous export of the same root file in close(), so a run
+# that fails leaves the database as it was; several exports may run into
+# the same database at the same time
+class SQLiteExporter:
+    indexes = [
+        ('forms_kind', 'forms(kind)'),
+        ('forms_name', 'forms(name)'),
+        ('forms_target', 'forms(target, root_file)'),
+        ('itor_values_form', 'itor_values(form_id)'),
+        ('itor_values_itor', 'itor_values(itor, member)'),
+    ]
+
+    def __init__(self, file_name:str, target:str, root_file:str, batch_size:int = 10000):
+        self.target = target
+        self.root_file = root_file
+        self.batch_size = batch_size
+        # transactions are managed by hand, wait for concurrent writers
+        self.db = sqlite3.connect(file_name, timeout=600, isolation_level=None)
+        self.db.execute('create table if not exists forms (id integer primary key, kind text, name text, '
+                        'target text, root_file text, source_file text, ast text)')
+        self.db.execute('create table if not exists itor_values (form_id integer, itor text, member text)')
+        # ids in the temp tables are local to this export
+        self.db.execute('create temp table new_forms (id integer primary key, kind text, name text, '
+                        'source_file text, ast text)')
+        self.db.execute('create temp table new_itor_values (form_id integer, itor text, member text)')
+        self.count = 0
+        self.forms = []
+        self.itor_values = []
+
+    def add(self, ast, source_file, itor_values):
+        form_id = self.count
+        self.count += 1
+        self.forms.append((form_id, Elaborator.get_list_form(ast), Elaborator.get_form_name(ast),
+                           source_file, json.dumps(ast_to_plain(ast))))
+        for itor, member in itor_values:
+            self.itor_values.append((form_id, itor, member))
+        if len(self.forms) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.db.execute('begin')
+        self.db.executemany('insert into new_forms values (?, ?, ?, ?, ?)', self.forms)
+        self.db.executemany('insert into new_itor_values values (?, ?, ?)', self.itor_values)
+        self.db.execute('commit')
+        self.forms = []
+        self.itor_values = []
+
+    # replace the previous export of this root file in one transaction,
+    # indexes are only built if they don't exist yet
+    def close(self):
+        self.flush()
+        self.db.execute('begin immediate')
+        self.db.execute('delete from itor_values where form_id in '
+                        '(select id from forms where target = ? and root_file = ?)', (self.target, self.root_file))
+        self.db.execute('delete from forms where target = ? and root_file = ?', (self.target, self.root_file))
+        base = self.db.execute('select coalesce(max(id), 0) + 1 from forms').fetchone()[0]
+        self.db.execute('insert into forms select id + ?, kind, name, ?, ?, source_file, ast from new_forms',
+                        (base, self.target, self.root_file))
+        self.db.execute('insert into itor_values select form_id + ?, itor, member from new_itor_values', (base,))
+        for index, columns in SQLiteExporter.indexes:
+            self.db.execute('create index if not exists {} on {}'.format(index, columns))
+        self.db.execute('commit')
+        self.db.close()
+
 def parse_rtl_identifier(lexer: Lexer):
     return (ASTKind.Identifier, lexer.consume(TokenKind.Identifier)[1])
 
@@ -721,7 +1570,6 @@ def parse_rtl_vector(lexer: Lexer):
     return (ASTKind.Vector, result)
 
 def parse_rtl_primary(lexer: Lexer):
-    token = lexer.peek()
     switcher = {
         TokenKind.OpenParen: parse_rtl_list,
         TokenKind.OpenBracket: parse_rtl_vector,
@@ -731,12 +1579,12 @@ def parse_rtl_primary(lexer: Lexer):
     }
     def error_handler(lexer: Lexer):
         raise ValueError()
-    handler = switcher.get(lexer.peek()[0], error_handler)
+    handler = switcher.get(lexer.peek_kind(), error_handler)
     return handler(lexer)
 
 def parse_rtl_file(lexer: Lexer):
     result = []
-    while lexer.next < len(lexer.buffer):
+    while not lexer.at_end():
         result.append(parse_rtl_list(lexer))
     return result
 
@@ -781,26 +1629,85 @@ def dump_ast(ast, indent = 0, os = sys.stdout):
     switcher[ast[0]](ast, indent, os)
 
 if __name__ == '__main__':
-    lexer = Lexer(sys.argv[1])
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('file')
+    arg_parser.add_argument('working_dir', nargs='?')
+    arg_parser.add_argument('--form-budget', type=int, default=None)
+    arg_parser.add_argument('--run-budget', type=int, default=None)
+    arg_parser.add_argument('--budget-policy', choices=[p.name.lower() for p in BudgetPolicy], default='stream')
+    arg_parser.add_argument('--expansion-stats', action='store_true')
+    arg_parser.add_argument('--compact-tokens', action='store_true')
+    arg_parser.add_argument('--no-prune-itors', action='store_true')
+    arg_parser.add_argument('--no-dedup', action='store_true')
+    # directory, one file per target and root .md file
+    arg_parser.add_argument('--cache')
+    arg_parser.add_argument('--target')
+    arg_parser.add_argument('--sqlite')
+    # e.g. --query predicate=nonimmediate_operand constraint=v mode=V8HI, all
+    # terms have to hold for the same operand, values may contain ','
+    arg_parser.add_argument('--query', action='append', nargs='+', default=[], metavar='FIELD=VALUE')
+    args = arg_parser.parse_args()
+    queries = []
+    for query in args.query:
+        terms = {}
+        for term in query:
+            field, sep, value = term.partition('=')
+            if sep == '' or field not in OperandIndex.fields:
+                arg_parser.error('bad query term {!r}, expected FIELD=VALUE with FIELD one of {}'.format(
+                    term, ', '.join(OperandIndex.fields)))
+            terms[field] = value
+        queries.append((' '.join(query), terms))
+    lexer_class = ArrayLexer if args.compact_tokens else Lexer
+    lexer = lexer_class(args.file)
     syntax_trees = parse_rtl_file(lexer)
-    elaborator = Elaborator(sys.argv[2] if len(sys.argv) > 2 else os.path.dirname(sys.argv[1]))
-    result = []
-    for tree in syntax_trees:
-        t = elaborator.elab(tree)
-        if isinstance(t, list):
-            result += t
-        else:
-            result.append(t)
-    for t in result:
-        dump_ast(t)
-    name_printer = lambda x: print(x[1][1][1])
+    working_dir = args.working_dir if args.working_dir else os.path.dirname(args.file)
+    # gcc/config/<target>/*.md
+    target = args.target if args.target else os.path.basename(os.path.abspath(working_dir))
+    source_file = os.path.relpath(args.file, working_dir)
+    cache = None
+    if args.cache:
+        cache = ExpansionCache(args.cache, target, source_file)
+    exporter = None
+    if args.sqlite:
+        exporter = SQLiteExporter(args.sqlite, target, source_file)
+    elaborator = Elaborator(working_dir,
+                            form_budget=args.form_budget, run_budget=args.run_budget,
+                            budget_policy=BudgetPolicy[args.budget_policy.capitalize()],
+                            lexer_class=lexer_class,
+                            prune_itors=not args.no_prune_itors, dedup=not args.no_dedup,
+                            cache=cache, index=OperandIndex() if args.query else None)
+    elaborator.source_file = source_file
+    name_printer = lambda x: x[1][1][1]
     switcher = {
         'define_insn': name_printer,
         'define_expand': name_printer,
     }
-    for t in result:
-        h = Elaborator.get_list_form(t)
-        handler = switcher.get(h, None)
-        if handler != None:
-            handler(t)
+    names = []
+    # dump as we go so that large expansions are never held in memory
+    try:
+        for tree in syntax_trees:
+            for t in elaborator.elab_iter(tree):
+                dump_ast(t)
+                if exporter != None:
+                    exporter.add(t, elaborator.source_file, elaborator.itor_values)
+                h = Elaborator.get_list_form(t)
+                handler = switcher.get(h, None)
+                if handler != None:
+                    names.append(handler(t))
+    except ExpansionBudgetExceeded as e:
+        # the cache and the export are left as they were
+        print('error: over budget, ' + str(e), file=sys.stderr)
+        sys.exit(1)
+    for name in names:
+        print(name)
+    if args.expansion_stats:
+        elaborator.dump_expansion_stats(os=sys.stderr)
+    if cache != None:
+        cache.dump_diff(os=sys.stderr)
+        cache.save()
+    if exporter != None:
+        exporter.close()
+    for query, terms in queries:
+        for pattern_id in elaborator.index.query(**terms):
+            print('{}\t{}\t{}'.format(query, *elaborator.index.patterns[pattern_id]), file=sys.stderr)
     #elaborator.dump_all_itors(os=sys.stdout)